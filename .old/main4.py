@@ -1,17 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import json
+import re
 import time
+from contextlib import asynccontextmanager
 from typing import Annotated, Literal, Optional
 from uuid import uuid4
-from fastapi import Depends, FastAPI, HTTPException, UploadFile, File
-from pydantic import BaseModel, Field
-from sqlalchemy import Column, Integer, String, Boolean, LargeBinary, ForeignKey, func
-from sqlalchemy.orm import relationship, Session
+from fastapi import Depends, FastAPI, HTTPException, Query
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field
+from sqlalchemy import Column, Index, Integer, SmallInteger, String, Boolean, LargeBinary, ForeignKey, event, exists, func, insert, select, update
+from sqlalchemy.orm import relationship, selectinload
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import create_engine
-import boto3
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import aioboto3
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 import stripe
+import ulid
 
 from dotenv import load_dotenv
 import os
@@ -22,21 +32,111 @@ stripe.api_key = os.getenv("STRIPE_API_KEY")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-
-
-app = FastAPI()
-
-stripe.api_key = "your_stripe_api_key"
-
-engine = create_engine("sqlite:///./database.db")
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./database.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+USER_CACHE_TTL_SECONDS = 300
+TASK_LIST_CACHE_TTL_SECONDS = 45
+TASK_LIST_STALE_TTL_SECONDS = 600
+TASK_LIST_LOCK_TTL_SECONDS = 5
+TASK_LIST_VERSION_KEY = "v1:tasks:ver"
+TASK_EXPIRY_KEY = "tasks:expire"
+STRIPE_CHARGE_QUEUE_KEY = "q:stripe:charge"
+STRIPE_CHARGE_PROCESSING_KEY = "q:stripe:charge:processing"
+STRIPE_CHARGE_RETRY_KEY = "q:stripe:charge:retry"
+STRIPE_CHARGE_MAX_ATTEMPTS = 5
+STRIPE_CHARGE_POLL_SECONDS = 1
+STRIPE_CHARGE_ERROR_SLEEP_SECONDS = 5
+TASK_EXPIRY_BATCH_SIZE = 256
+TASK_EXPIRY_MAX_SLEEP_SECONDS = 60
+S3_CLIENT_CONFIG = AioConfig(max_pool_connections=64, retries={"mode": "adaptive"})
+S3_PRESIGN_EXPIRES_SECONDS = 300
+
+redis = Redis.from_url(REDIS_URL, decode_responses=True)
+
+# Opened once for the lifetime of the app and shared by every request
+s3_session = aioboto3.Session()
+s3 = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global s3
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with s3_session.client("s3", config=S3_CLIENT_CONFIG) as s3:
+        await schedule_accepted_tasks()
+        expiry_worker = asyncio.create_task(expire_tasks_worker())
+        await requeue_unfinished_charges()
+        charge_worker = asyncio.create_task(charge_completed_tasks_worker())
+        yield
+        expiry_worker.cancel()
+        charge_worker.cancel()
+    await redis.aclose()
+    await engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+
+engine = create_async_engine(
+    DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=3600,
+    connect_args={"check_same_thread": False},
+    query_cache_size=1200,
+)
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
-def get_db():
-    db = Session(engine)
-    try:
+STATUS_UNASSIGNED = 0
+STATUS_ACCEPTED = 1
+STATUS_COMPLETED = 2
+STATUS_CANCELED = 3
+TASK_STATUSES = {
+    "unassigned": STATUS_UNASSIGNED,
+    "accepted": STATUS_ACCEPTED,
+    "completed": STATUS_COMPLETED,
+    "canceled": STATUS_CANCELED,
+}
+TASK_STATUS_NAMES = {value: name for name, value in TASK_STATUSES.items()}
+
+TaskStatusName = Annotated[
+    Literal["unassigned", "accepted", "completed", "canceled"],
+    BeforeValidator(lambda value: TASK_STATUS_NAMES[value] if isinstance(value, int) else value),
+]
+
+# Accepted tasks not completed within this window are canceled by the expiry worker
+COMPLETION_EXPIRATION_NS = 24 * 60 * 60 * 1_000_000_000
+
+def task_expiry_deadline_ms(accepted_time_ns: int) -> int:
+    return (accepted_time_ns + COMPLETION_EXPIRATION_NS) // 1_000_000
+
+# Task and message ids are ULIDs stored as 16-byte blobs and exposed over the API as hex
+def new_ulid() -> bytes:
+    # Monotonic so ids minted within the same millisecond still sort in creation order
+    return ulid.monotonic.new().bytes
+
+def parse_ulid(value: str) -> bytes:
+    if not re.fullmatch(r"[0-9a-fA-F]{32}", value):
+        raise HTTPException(status_code=400, detail="Invalid id")
+    return bytes.fromhex(value)
+
+HexId = Annotated[str, BeforeValidator(lambda value: value.hex() if isinstance(value, bytes) else value)]
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 class User(Base):
     __tablename__ = "users"
@@ -47,7 +147,6 @@ class User(Base):
     created_at = Column(Integer, default=time.time_ns)
     
     banned = Column(Boolean, default=False)
-    blocked_user_ids = Column(String, default="")
     
     min_task_price = Column(Integer, default=0)
     stripe_customer_id = Column(String)
@@ -55,11 +154,17 @@ class User(Base):
     requested_tasks = relationship("Task", back_populates="requested_by", foreign_keys="Task.requested_by_id")
     executed_tasks = relationship("Task", back_populates="executed_by", foreign_keys="Task.executed_by_id")
 
+class BlockedUser(Base):
+    __tablename__ = "blocked_users"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    blocked_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+
 class Task(Base):
     __tablename__ = "tasks"
     
-    id = Column(Integer, primary_key=True, index=True)
-    description = Column(String, index=True)
+    id = Column(LargeBinary(16), primary_key=True, default=new_ulid)
+    description = Column(String)
     max_price = Column(Integer)
     min_price = Column(Integer)
     
@@ -73,32 +178,33 @@ class Task(Base):
     accepted_time_ns = Column(Integer)
     completed_time_ns = Column(Integer)
     canceled_time_ns = Column(Integer)
+    status = Column(SmallInteger, default=STATUS_UNASSIGNED, index=True)
     
     stripe_payment_intent_id = Column(String)
+    charged_time_ns = Column(Integer)
+    payment_error = Column(String)
     
     messages = relationship("Message", back_populates="task")
     
-    @hybrid_property
-    def status(self) -> Literal["unassigned", "accepted", "completed", "canceled"]:
-        if self.canceled_time_ns:
-            return "canceled"
-        elif self.completed_time_ns:
-            return "completed"
-        elif self.accepted_time_ns:
-            return "accepted"
-        else:
-            return "unassigned"
+    __table_args__ = (
+        Index("ix_task_unassigned", requested_by_id, sqlite_where=status == STATUS_UNASSIGNED),
+        Index("ix_task_executor", executed_by_id, status),
+    )
 
 class Message(Base):
     __tablename__ = "messages"
     
-    id = Column(Integer, primary_key=True, index=True)
-    task_id = Column(Integer, ForeignKey("tasks.id"))
+    id = Column(LargeBinary(16), primary_key=True, default=new_ulid)
+    task_id = Column(LargeBinary(16), ForeignKey("tasks.id"))
     sender_id = Column(Integer, ForeignKey("users.id"))
     text = Column(String)
     image_url = Column(String)
     
     task = relationship("Task", back_populates="messages")
+    
+    __table_args__ = (
+        Index("ix_msg_task_id", task_id, id),
+    )
 
 # Added for thoroughness, but not used
 class UserCreate(BaseModel):
@@ -122,37 +228,125 @@ class TaskUpdate(BaseModel):
     min_price: int
 
 class TaskQuery(BaseModel):
-    status: Optional[Literal["unassigned", "accepted", "completed", "canceled"]]
+    status: Optional[Literal["unassigned", "accepted", "completed", "canceled"]] = None
+    requested_by_id: Optional[int] = None
+    executed_by_id: Optional[int] = None
+
+class TaskRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: HexId
+    description: str
+    status: TaskStatusName
+    min_price: int
+    max_price: int
     requested_by_id: Optional[int]
     executed_by_id: Optional[int]
 
-CurrentUser = Annotated[User, Depends(get_current_user)]
+class MessageRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: HexId
+    task_id: HexId
+    sender_id: int
+    text: Optional[str]
+    image_url: Optional[str]
+
+class MessageCreate(BaseModel):
+    text: str
 
-def get_current_user(identity: str, db: Session = Depends(get_db)) -> User:
-    user = db.query(User).filter(User.identity == identity).first()
+class MessageBatchCreate(BaseModel):
+    items: list[MessageCreate]
+
+class ImageUploadPresign(BaseModel):
+    upload_url: str
+    object_name: str
+
+class ImageMessageCreate(BaseModel):
+    object_name: str
+
+def user_cache_key(identity: str) -> str:
+    return f"v1:app:user:identity:{identity}"
+
+async def get_current_user(identity: str, db: AsyncSession = Depends(get_db)) -> User:
+    # Cache-aside: a hit returns a detached User built from the cached columns.
+    # Redis errors fall through to the database so an outage only costs the cache.
+    try:
+        cached = await redis.get(user_cache_key(identity))
+        if cached:
+            return User(**json.loads(cached))
+    except RedisError as e:
+        print(f"Error reading cached user: {str(e)}")
+    
+    user = (await db.execute(select(User).where(User.identity == identity))).scalar_one_or_none()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    
+    user_data = {column.name: getattr(user, column.name) for column in User.__table__.columns}
+    try:
+        await redis.set(user_cache_key(identity), json.dumps(user_data), ex=USER_CACHE_TTL_SECONDS)
+    except RedisError as e:
+        print(f"Error caching user: {str(e)}")
     return user
 
+CurrentUser = Annotated[User, Depends(get_current_user)]
+
+async def task_list_cache_keys(query: TaskQuery, skip: int, limit: int, user_id: int) -> tuple[str, str]:
+    # Fresh keys embed a version counter, so bumping it invalidates every cached page at once.
+    # The stale copy is unversioned so it survives invalidation and can be served while one caller rebuilds.
+    version = await redis.get(TASK_LIST_VERSION_KEY) or "0"
+    digest = hashlib.sha1(json.dumps([query.status, query.requested_by_id, query.executed_by_id, skip, limit]).encode()).hexdigest()
+    return f"v1:tasks:list:{version}:{digest}:blk{user_id}", f"v1:tasks:list:stale:{digest}:blk{user_id}"
+
+async def invalidate_task_lists():
+    await redis.incr(TASK_LIST_VERSION_KEY)
+
+async def get_cached_task_list(cache_key: str, stale_key: str, load_tasks) -> list[dict]:
+    pipe = redis.pipeline(transaction=False)
+    pipe.get(cache_key)
+    pipe.ttl(cache_key)
+    cached, ttl = await pipe.execute()
+    # Serve fresh hits until 80% of the TTL has elapsed, then start refreshing early
+    if cached and ttl > TASK_LIST_CACHE_TTL_SECONDS * 0.2:
+        return json.loads(cached)
+    
+    # Only the lock holder rebuilds; everyone else keeps serving the stale copy
+    lock_key = f"{cache_key}:lock"
+    has_lock = await redis.set(lock_key, 1, nx=True, ex=TASK_LIST_LOCK_TTL_SECONDS)
+    if not has_lock:
+        stale = cached or await redis.get(stale_key)
+        if stale:
+            return json.loads(stale)
+    
+    task_data = await load_tasks()
+    payload = json.dumps(task_data)
+    pipe = redis.pipeline(transaction=False)
+    pipe.set(cache_key, payload, ex=TASK_LIST_CACHE_TTL_SECONDS)
+    pipe.set(stale_key, payload, ex=TASK_LIST_STALE_TTL_SECONDS)
+    if has_lock:
+        pipe.delete(lock_key)
+    await pipe.execute()
+    return task_data
+
 @app.post("/users", response_model=int)
-def create_user(create_user_data: UserCreate, db: Session = Depends(get_db)) -> int:
+async def create_user(create_user_data: UserCreate, db: AsyncSession = Depends(get_db)) -> int:
     try:
         user = User(**create_user_data.dict())
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         return user.id
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/users/{user_id}", response_model=int)
-def update_user(user_id: int, update_user_data: UserUpdate, current_user: CurrentUser, db: Session = Depends(get_db)) -> int:
+async def update_user(user_id: int, update_user_data: UserUpdate, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> int:
     if current_user.id != user_id:
         raise HTTPException(status_code=403, detail="You can only update your own profile")
     
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = (await db.execute(select(User).where(User.id == user_id))).scalar_one_or_none()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -160,227 +354,391 @@ def update_user(user_id: int, update_user_data: UserUpdate, current_user: Curren
             setattr(user, key, value)
         
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
+        await redis.delete(user_cache_key(user.identity))
         return user.id
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/tasks", response_model=int)
-def create_task(create_task_data: TaskCreate, current_user: CurrentUser, db: Session = Depends(get_db)) -> int:
+@app.post("/tasks", response_model=str)
+async def create_task(create_task_data: TaskCreate, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> str:
     try:
-        task = Task(**create_task_data.dict(), requested_by_id=current_user.id)
-        db.add(task)
-        db.commit()
-        db.refresh(task)
-        return task.id
+        task_id = new_ulid()
+        await db.execute(insert(Task).values(id=task_id, **create_task_data.dict(), requested_by_id=current_user.id))
+        await db.commit()
+        await invalidate_task_lists()
+        return task_id.hex()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/tasks", response_model=list[Task])
-def get_available_tasks(query: TaskQuery = Depends(), current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db), skip: int = 0, limit: int = 100) -> list[Task]:
+@app.get("/tasks", response_model=list[TaskRead])
+async def get_available_tasks(current_user: CurrentUser, query: TaskQuery = Depends(), db: AsyncSession = Depends(get_db), skip: int = 0, limit: int = 100) -> list[TaskRead]:
     try:
-        tasks_query = db.query(Task)
-        if query.status:
-            if query.status == "unassigned":
-                tasks_query = tasks_query.filter(Task.accepted_time_ns == None, Task.completed_time_ns == None, Task.canceled_time_ns == None)
-            elif query.status == "accepted":
-                tasks_query = tasks_query.filter(Task.accepted_time_ns != None, Task.completed_time_ns == None, Task.canceled_time_ns == None)
-            elif query.status == "completed":
-                tasks_query = tasks_query.filter(Task.completed_time_ns != None)
-            elif query.status == "canceled":
-                tasks_query = tasks_query.filter(Task.canceled_time_ns != None)
-        if query.requested_by_id:
-            tasks_query = tasks_query.filter(Task.requested_by_id == query.requested_by_id)
-        if query.executed_by_id:
-            tasks_query = tasks_query.filter(Task.executed_by_id == query.executed_by_id)
-        
-        blocked_user_ids = current_user.blocked_user_ids.split(",") if current_user.blocked_user_ids else []
-        tasks_query = tasks_query.filter(Task.requested_by_id.not_in(blocked_user_ids))
+        async def load_tasks() -> list[dict]:
+            # Select only the DTO columns so rows map straight into TaskRead without building ORM objects
+            tasks_query = select(Task.id, Task.description, Task.status, Task.min_price, Task.max_price, Task.requested_by_id, Task.executed_by_id)
+            if query.status:
+                tasks_query = tasks_query.where(Task.status == TASK_STATUSES[query.status])
+            if query.requested_by_id:
+                tasks_query = tasks_query.where(Task.requested_by_id == query.requested_by_id)
+            if query.executed_by_id:
+                tasks_query = tasks_query.where(Task.executed_by_id == query.executed_by_id)
+            
+            tasks_query = tasks_query.where(~exists().where(BlockedUser.user_id == current_user.id, BlockedUser.blocked_id == Task.requested_by_id))
+            
+            rows = (await db.execute(tasks_query.offset(skip).limit(limit))).all()
+            return [TaskRead(**row._mapping).model_dump() for row in rows]
         
-        tasks = tasks_query.offset(skip).limit(limit).all()
-        return tasks
+        cache_key, stale_key = await task_list_cache_keys(query, skip, limit, current_user.id)
+        return await get_cached_task_list(cache_key, stale_key, load_tasks)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.put("/tasks/{task_id}/accept", response_model=int)
-def accept_task(task_id: int, current_user: CurrentUser, db: Session = Depends(get_db)) -> int:
+@app.put("/tasks/{task_id}/accept", response_model=str)
+async def accept_task(task_id: str, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> str:
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
         if not task:
             raise HTTPException(status_code=404, detail="The task does not exist")
-        if task.status != "unassigned":
+        if task.status != STATUS_UNASSIGNED:
             raise HTTPException(status_code=400, detail="The task is not unassigned")
-        if str(task.requested_by_id) in current_user.blocked_user_ids.split(","):
+        if await db.get(BlockedUser, (current_user.id, task.requested_by_id)):
             raise HTTPException(status_code=403, detail="You have blocked the requester of this task")
         if task.min_price < current_user.min_task_price:
             raise HTTPException(status_code=403, detail="The task price is below your minimum")
         
-        task.accepted_time_ns = time.time_ns()
-        task.executed_by_id = current_user.id
+        # Conditional UPDATE so two executors racing for the same task cannot both accept it
+        accepted_time_ns = time.time_ns()
+        result = await db.execute(
+            update(Task)
+            .where(Task.id == task.id, Task.status == STATUS_UNASSIGNED)
+            .values(status=STATUS_ACCEPTED, accepted_time_ns=accepted_time_ns, executed_by_id=current_user.id)
+        )
+        if not result.rowcount:
+            raise HTTPException(status_code=400, detail="The task is not unassigned")
+        await db.commit()
+        await invalidate_task_lists()
+        await redis.zadd(TASK_EXPIRY_KEY, {task.id.hex(): task_expiry_deadline_ms(accepted_time_ns)})
+        return task.id.hex()
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/{task_id}/messages/text", response_model=str)
+async def add_text_message_to_task(task_id: str, text_content: str, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> str:
+    try:
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
+        if not task:
+            raise HTTPException(status_code=404, detail="The task does not exist")
+        if task.status != STATUS_ACCEPTED:
+            raise HTTPException(status_code=400, detail="The task is not in progress")
+        if current_user.id != task.requested_by_id and current_user.id != task.executed_by_id:
+            raise HTTPException(status_code=403, detail="You are not authorized to add messages to this task")
         
-        db.add(task)
-        db.commit()
-        db.refresh(task)
-        return task.id
+        message_id = new_ulid()
+        await db.execute(insert(Message).values(id=message_id, task_id=task.id, sender_id=current_user.id, text=text_content))
+        await db.commit()
+        return message_id.hex()
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/tasks/{task_id}/messages/text", response_model=int)
-def add_text_message_to_task(task_id: int, text_content: str, current_user: CurrentUser, db: Session = Depends(get_db)) -> int:
+@app.post("/tasks/{task_id}/messages/batch", response_model=list[str])
+async def add_text_messages_to_task(task_id: str, batch: MessageBatchCreate, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> list[str]:
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
         if not task:
             raise HTTPException(status_code=404, detail="The task does not exist")
-        if task.status != "accepted":
+        if task.status != STATUS_ACCEPTED:
             raise HTTPException(status_code=400, detail="The task is not in progress")
         if current_user.id != task.requested_by_id and current_user.id != task.executed_by_id:
             raise HTTPException(status_code=403, detail="You are not authorized to add messages to this task")
+        if not batch.items:
+            return []
         
-        message = Message(task_id=task_id, sender_id=current_user.id, text=text_content)
-        db.add(message)
-        db.commit()
-        db.refresh(message)
-        return message.id
+        # One executemany INSERT inside a single transaction; ids are generated here so nothing needs returning
+        rows = [item.dict() | {"id": new_ulid(), "task_id": task.id, "sender_id": current_user.id} for item in batch.items]
+        await db.execute(insert(Message), rows)
+        await db.commit()
+        return [row["id"].hex() for row in rows]
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/tasks/{task_id}/messages/image", response_model=int)
-def add_image_message_to_task(task_id: int, image: UploadFile = File(...), current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)) -> int:
+@app.post("/tasks/{task_id}/messages/image/presign", response_model=ImageUploadPresign)
+async def presign_image_message_upload(task_id: str, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> ImageUploadPresign:
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
         if not task:
             raise HTTPException(status_code=404, detail="The task does not exist")
-        if task.status != "accepted":
+        if task.status != STATUS_ACCEPTED:
             raise HTTPException(status_code=400, detail="The task is not in progress")
         if current_user.id != task.requested_by_id and current_user.id != task.executed_by_id:
             raise HTTPException(status_code=403, detail="You are not authorized to add messages to this task")
         
-        # Upload image to S3 and get the URL
-        s3 = boto3.client("s3")
-        bucket_name = S3_BUCKET_NAME
-        object_name = f"task_{task_id}_message_{uuid4()}.jpg"
-        s3.upload_fileobj(image.file, bucket_name, object_name)
-        image_url = f"https://{bucket_name}.s3.amazonaws.com/{object_name}"
+        # The client PUTs the image straight to S3, so the bytes never pass through this process
+        object_name = f"task_{task.id.hex()}_message_{uuid4()}.jpg"
+        upload_url = await s3.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": S3_BUCKET_NAME, "Key": object_name, "ContentType": "image/jpeg"},
+            ExpiresIn=S3_PRESIGN_EXPIRES_SECONDS,
+        )
+        return ImageUploadPresign(upload_url=upload_url, object_name=object_name)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/{task_id}/messages/image", response_model=str)
+async def add_image_message_to_task(task_id: str, image_message_data: ImageMessageCreate, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> str:
+    try:
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
+        if not task:
+            raise HTTPException(status_code=404, detail="The task does not exist")
+        if task.status != STATUS_ACCEPTED:
+            raise HTTPException(status_code=400, detail="The task is not in progress")
+        if current_user.id != task.requested_by_id and current_user.id != task.executed_by_id:
+            raise HTTPException(status_code=403, detail="You are not authorized to add messages to this task")
+        if not image_message_data.object_name.startswith(f"task_{task.id.hex()}_message_"):
+            raise HTTPException(status_code=400, detail="The image was not uploaded for this task")
+        try:
+            await s3.head_object(Bucket=S3_BUCKET_NAME, Key=image_message_data.object_name)
+        except ClientError:
+            raise HTTPException(status_code=400, detail="The image has not been uploaded")
         
-        message = Message(task_id=task_id, sender_id=current_user.id, image_url=image_url)
-        db.add(message)
-        db.commit()
-        db.refresh(message)
-        return message.id
+        image_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{image_message_data.object_name}"
+        message_id = new_ulid()
+        await db.execute(insert(Message).values(id=message_id, task_id=task.id, sender_id=current_user.id, image_url=image_url))
+        await db.commit()
+        return message_id.hex()
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/tasks/{task_id}/messages", response_model=list[Message])
-def get_messages_for_task(task_id: int, current_user: CurrentUser, db: Session = Depends(get_db), start: int = 0, end: int = None) -> list[Message]:
+@app.get("/tasks/{task_id}/messages", response_model=list[MessageRead])
+async def get_messages_for_task(task_id: str, current_user: CurrentUser, db: AsyncSession = Depends(get_db), after_id: Optional[str] = None, limit: int = Query(100, ge=1, le=500)) -> list[MessageRead]:
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
         if not task:
             raise HTTPException(status_code=404, detail="The task does not exist")
         if current_user.id != task.requested_by_id and current_user.id != task.executed_by_id:
             raise HTTPException(status_code=403, detail="You are not authorized to view messages for this task")
         
-        messages_query = db.query(Message).filter(Message.task_id == task_id)
-        if end:
-            messages_query = messages_query.slice(start, end)
-        else:
-            messages_query = messages_query.offset(start)
+        # Keyset pagination: each page is a range seek on (task_id, id) rather than an OFFSET scan
+        messages_query = select(Message.id, Message.task_id, Message.sender_id, Message.text, Message.image_url).where(Message.task_id == task.id)
+        if after_id is not None:
+            messages_query = messages_query.where(Message.id > parse_ulid(after_id))
+        messages_query = messages_query.order_by(Message.id).limit(limit)
         
-        messages = messages_query.all()
-        return messages
+        rows = (await db.execute(messages_query)).all()
+        return [MessageRead(**row._mapping) for row in rows]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.put("/tasks/{task_id}/cancel", response_model=int)
-def cancel_task(task_id: int, current_user: CurrentUser, db: Session = Depends(get_db)) -> int:
+@app.put("/tasks/{task_id}/cancel", response_model=str)
+async def cancel_task(task_id: str, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> str:
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
         if not task:
             raise HTTPException(status_code=404, detail="The task does not exist")
-        if task.status != "accepted":
+        if task.status != STATUS_ACCEPTED:
             raise HTTPException(status_code=400, detail="The task is not in progress")
         if current_user.id != task.requested_by_id:
             raise HTTPException(status_code=403, detail="Only the task requester can cancel the task")
         
-        task.canceled_time_ns = time.time_ns()
-        
-        db.add(task)
-        db.commit()
-        db.refresh(task)
-        return task.id
+        # Conditional UPDATE so a cancel cannot overwrite a completion or expiry that landed first
+        result = await db.execute(
+            update(Task)
+            .where(Task.id == task.id, Task.status == STATUS_ACCEPTED)
+            .values(status=STATUS_CANCELED, canceled_time_ns=time.time_ns())
+        )
+        if not result.rowcount:
+            raise HTTPException(status_code=400, detail="The task is not in progress")
+        await db.commit()
+        await invalidate_task_lists()
+        await redis.zrem(TASK_EXPIRY_KEY, task.id.hex())
+        return task.id.hex()
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.put("/tasks/{task_id}/complete", response_model=int)
-def complete_task(task_id: int, current_user: CurrentUser, db: Session = Depends(get_db)) -> int:
+@app.put("/tasks/{task_id}/complete", response_model=str)
+async def complete_task(task_id: str, current_user: CurrentUser, db: AsyncSession = Depends(get_db)) -> str:
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        task = (await db.execute(select(Task).where(Task.id == parse_ulid(task_id)))).scalar_one_or_none()
         if not task:
             raise HTTPException(status_code=404, detail="The task does not exist")
-        if task.status != "accepted":
+        if task.status != STATUS_ACCEPTED:
             raise HTTPException(status_code=400, detail="The task is not in progress")
         if current_user.id != task.executed_by_id:
             raise HTTPException(status_code=403, detail="Only the task executor can complete the task")
         
-        task.completed_time_ns = time.time_ns()
-        
-        db.add(task)
-        db.commit()
-        db.refresh(task)
-        
-        # Process payment using Stripe
-        try:
-            payment_intent = stripe.PaymentIntent.create(
-                amount=task.max_price,
-                currency="usd",
-                customer=task.requested_by.stripe_customer_id,
-                payment_method=task.stripe_payment_intent_id,
-                off_session=True,
-                confirm=True,
-            )
-            # Handle successful payment
-            print(f"Payment successful. Payment Intent ID: {payment_intent.id}")
-        except stripe.error.StripeError as e:
-            # Handle Stripe error
-            print(f"Stripe error: {str(e)}")
-            raise HTTPException(status_code=400, detail="Payment failed")
+        # Conditional UPDATE so a completion cannot overwrite a cancel or expiry that landed first
+        result = await db.execute(
+            update(Task)
+            .where(Task.id == task.id, Task.status == STATUS_ACCEPTED)
+            .values(status=STATUS_COMPLETED, completed_time_ns=time.time_ns())
+        )
+        if not result.rowcount:
+            raise HTTPException(status_code=400, detail="The task is not in progress")
+        await db.commit()
+        await invalidate_task_lists()
+        await redis.zrem(TASK_EXPIRY_KEY, task.id.hex())
         
-        return task.id
+        # The Stripe charge is made by charge_completed_tasks_worker, off the request path
+        await redis.lpush(STRIPE_CHARGE_QUEUE_KEY, json.dumps({"task_id": task.id.hex()}))
+        return task.id.hex()
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-def check_expired_tasks(db: Session):
+async def charge_completed_task(db: AsyncSession, task_id: bytes):
+    task = (await db.execute(select(Task).options(selectinload(Task.requested_by)).where(Task.id == task_id))).scalar_one_or_none()
+    # Only completed tasks are charged, and a replayed job for a task that was already charged is a no-op
+    if not task or task.status != STATUS_COMPLETED or task.charged_time_ns:
+        return
+    
+    # Process payment using Stripe; the idempotency key stops a retried job from charging twice
+    try:
+        payment_intent = await asyncio.to_thread(
+            stripe.PaymentIntent.create,
+            amount=task.max_price,
+            currency="usd",
+            customer=task.requested_by.stripe_customer_id,
+            payment_method=task.stripe_payment_intent_id,
+            off_session=True,
+            confirm=True,
+            idempotency_key=task.id.hex(),
+        )
+    except stripe.error.StripeError as e:
+        task.payment_error = str(e)
+        await db.commit()
+        raise
+    
+    # Handle successful payment
+    print(f"Payment successful. Payment Intent ID: {payment_intent.id}")
+    task.stripe_payment_intent_id = payment_intent.id
+    task.charged_time_ns = time.time_ns()
+    task.payment_error = None
+    await db.commit()
+
+async def process_charge_job(job: str):
+    payload = json.loads(job)
+    try:
+        async with AsyncSessionLocal() as db:
+            await charge_completed_task(db, bytes.fromhex(payload["task_id"]))
+    except (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError) as e:
+        attempts = payload.get("attempts", 0) + 1
+        if attempts < STRIPE_CHARGE_MAX_ATTEMPTS:
+            # Park the job in the retry set with its back-off as the score instead of sleeping on the queue
+            print(f"Stripe error, retrying charge (attempt {attempts}): {str(e)}")
+            due_ms = time.time_ns() // 1_000_000 + 1000 * 2 ** attempts
+            await redis.zadd(STRIPE_CHARGE_RETRY_KEY, {json.dumps(payload | {"attempts": attempts}): due_ms})
+        else:
+            print(f"Stripe error, giving up after {attempts} attempts: {str(e)}")
+    except stripe.error.StripeError as e:
+        # Declines and other permanent errors are recorded on Task.payment_error
+        print(f"Stripe error: {str(e)}")
+    await redis.lrem(STRIPE_CHARGE_PROCESSING_KEY, 1, job)
+
+async def requeue_due_charge_retries():
+    now_ms = time.time_ns() // 1_000_000
+    for job in await redis.zrangebyscore(STRIPE_CHARGE_RETRY_KEY, "-inf", now_ms):
+        # Pushed before it is removed, so a crash in between only duplicates the job, which the idempotency key absorbs
+        await redis.lpush(STRIPE_CHARGE_QUEUE_KEY, job)
+        await redis.zrem(STRIPE_CHARGE_RETRY_KEY, job)
+
+async def requeue_unfinished_charges():
+    # Jobs still in the processing list were interrupted mid-charge; put them back on the queue
+    while await redis.lmove(STRIPE_CHARGE_PROCESSING_KEY, STRIPE_CHARGE_QUEUE_KEY, src="RIGHT", dest="RIGHT"):
+        pass
+
+async def charge_completed_tasks_worker():
+    # BLMOVE keeps each job in the processing list until it is settled, so a crash cannot drop it
+    while True:
+        try:
+            await requeue_due_charge_retries()
+            job = await redis.blmove(STRIPE_CHARGE_QUEUE_KEY, STRIPE_CHARGE_PROCESSING_KEY, STRIPE_CHARGE_POLL_SECONDS, src="RIGHT", dest="LEFT")
+            if job is None:
+                continue
+            await process_charge_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in Stripe charge worker: {str(e)}")
+            await asyncio.sleep(STRIPE_CHARGE_ERROR_SLEEP_SECONDS)
+
+async def expire_tasks(db: AsyncSession, task_ids: list[bytes]):
     try:
         now = time.time_ns()
-        expired_tasks = db.query(Task).filter(
-            Task.status == "accepted",
-            Task.accepted_time_ns + Task.completion_expiration_duration < now
-        ).all()
-        
-        for task in expired_tasks:
-            task.canceled_time_ns = now
-            db.add(task)
-        
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        print(f"Error checking expired tasks: {str(e)}")
-
-# Set up a scheduled job to check for expired tasks every minute
-from apscheduler.schedulers.background import BackgroundScheduler
-
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=lambda: check_expired_tasks(next(get_db())), trigger="interval", minutes=1)
-scheduler.start()
-
-Base.metadata.create_all(bind=engine)
+        result = await db.execute(
+            update(Task)
+            .where(Task.id.in_(task_ids), Task.status == STATUS_ACCEPTED)
+            .values(status=STATUS_CANCELED, canceled_time_ns=now)
+        )
+        await db.commit()
+        if result.rowcount:
+            await invalidate_task_lists()
+    except Exception:
+        await db.rollback()
+        raise
+
+async def expire_due_tasks(now_ms: int) -> bool:
+    # Accepted tasks sit in a sorted set scored by their deadline, so each pass only touches tasks that are due
+    task_ids = await redis.zrangebyscore(TASK_EXPIRY_KEY, "-inf", now_ms, start=0, num=TASK_EXPIRY_BATCH_SIZE)
+    if not task_ids:
+        return False
+    async with AsyncSessionLocal() as db:
+        await expire_tasks(db, [bytes.fromhex(task_id) for task_id in task_ids])
+    # Drop the deadlines only once the UPDATE has committed; a failure leaves them due for the next pass
+    await redis.zrem(TASK_EXPIRY_KEY, *task_ids)
+    return True
+
+async def expire_tasks_worker():
+    while True:
+        try:
+            now_ms = time.time_ns() // 1_000_000
+            if await expire_due_tasks(now_ms):
+                continue
+            
+            next_due = await redis.zrange(TASK_EXPIRY_KEY, 0, 0, withscores=True)
+            delay = (next_due[0][1] - now_ms) / 1000 if next_due else TASK_EXPIRY_MAX_SLEEP_SECONDS
+            await asyncio.sleep(min(max(delay, 0), TASK_EXPIRY_MAX_SLEEP_SECONDS))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in task expiry worker: {str(e)}")
+            await asyncio.sleep(TASK_EXPIRY_MAX_SLEEP_SECONDS)
+
+async def schedule_accepted_tasks():
+    # Re-seed the expiry set from the database so tasks accepted while Redis was empty still expire
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(select(Task.id, Task.accepted_time_ns).where(Task.status == STATUS_ACCEPTED))).all()
+    if rows:
+        await redis.zadd(TASK_EXPIRY_KEY, {task_id.hex(): task_expiry_deadline_ms(accepted_time_ns) for task_id, accepted_time_ns in rows})
 
 if __name__ == "__main__":
     import uvicorn
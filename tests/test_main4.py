@@ -0,0 +1,404 @@
+import importlib.util
+import json
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from botocore.exceptions import ClientError
+from fastapi.testclient import TestClient
+from sqlalchemy import Select, delete, event
+from sqlalchemy.orm import Session, raiseload
+
+MAIN4_PATH = Path(__file__).resolve().parent.parent / ".old" / "main4.py"
+
+def load_main4():
+    spec = importlib.util.spec_from_file_location("main4", MAIN4_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # Registered before exec so Pydantic can resolve the module's annotations
+    sys.modules["main4"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def forbid_lazy_loads(orm_execute_state):
+    # Any relationship a handler touches without eager-loading it raises instead of issuing an N+1 query
+    statement = orm_execute_state.statement
+    if isinstance(statement, Select) and any(
+        desc.get("entity") is not None and desc["expr"] is desc["entity"] for desc in statement.column_descriptions
+    ):
+        orm_execute_state.statement = statement.options(raiseload("*"))
+
+@pytest.fixture
+def main4(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite+aiosqlite:///{tmp_path / 'database.db'}")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    module = load_main4()
+    event.listen(Session, "do_orm_execute", forbid_lazy_loads)
+    yield module
+    event.remove(Session, "do_orm_execute", forbid_lazy_loads)
+    sys.modules.pop("main4", None)
+
+@pytest.fixture
+def redis_server(main4, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(main4, "redis", fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    return server
+
+@pytest.fixture
+def client(main4, redis_server):
+    with TestClient(main4.app) as client:
+        yield client
+
+def create_user(client, identity):
+    response = client.post("/users", json={"display_name": identity, "identity": identity})
+    assert response.status_code == 200
+    return response.json()
+
+def create_task(client, identity, description="Test Task"):
+    response = client.post("/tasks", params={"identity": identity}, json={"description": description, "max_price": 100, "min_price": 50})
+    assert response.status_code == 200
+    return response.json()
+
+def accept_task(client, identity, task_id):
+    return client.put(f"/tasks/{task_id}/accept", params={"identity": identity})
+
+def list_tasks(client, identity, **filters):
+    response = client.get("/tasks", params={"identity": identity, **filters})
+    assert response.status_code == 200
+    return response.json()
+
+def test_create_and_accept_task(client):
+    requester_id = create_user(client, "requester")
+    executor_id = create_user(client, "executor")
+    task_id = create_task(client, "requester")
+
+    [task] = list_tasks(client, "executor")
+    assert task["id"] == task_id
+    assert task["status"] == "unassigned"
+    assert task["requested_by_id"] == requester_id
+
+    assert accept_task(client, "executor", task_id).status_code == 200
+    [task] = list_tasks(client, "executor", status="accepted")
+    assert task["executed_by_id"] == executor_id
+    assert list_tasks(client, "executor", status="unassigned") == []
+
+def test_unknown_identity_is_rejected(client):
+    assert client.get("/tasks", params={"identity": "nobody"}).status_code == 404
+
+def test_connections_use_wal(client, main4):
+    async def read_pragmas():
+        async with main4.engine.connect() as conn:
+            journal_mode = (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar()
+            foreign_keys = (await conn.exec_driver_sql("PRAGMA foreign_keys")).scalar()
+            return journal_mode, foreign_keys
+
+    assert client.portal.call(read_pragmas) == ("wal", 1)
+
+def block_user(client, main4, user_id, blocked_id):
+    async def insert_block():
+        async with main4.AsyncSessionLocal() as db:
+            db.add(main4.BlockedUser(user_id=user_id, blocked_id=blocked_id))
+            await db.commit()
+
+    client.portal.call(insert_block)
+
+def test_blocked_requesters_are_hidden(client, main4):
+    requester_id = create_user(client, "requester")
+    viewer_id = create_user(client, "viewer")
+    create_task(client, "requester")
+    block_user(client, main4, viewer_id, requester_id)
+
+    assert list_tasks(client, "viewer") == []
+    assert len(list_tasks(client, "requester")) == 1
+
+def test_listing_filters_use_indexes(client, main4):
+    async def explain(statement):
+        async with main4.engine.connect() as conn:
+            rows = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}")).all()
+            return " ".join(row[-1] for row in rows)
+
+    unassigned_plan = client.portal.call(explain, "SELECT id FROM tasks WHERE requested_by_id = 1 AND status = 0")
+    # Either ix_task_unassigned or ix_tasks_status may win on an empty table; neither scans
+    assert unassigned_plan.startswith("SEARCH tasks USING INDEX")
+    executor_plan = client.portal.call(explain, "SELECT id FROM tasks WHERE executed_by_id = 1 AND status = 1")
+    assert "ix_task_executor (executed_by_id=? AND status=?)" in executor_plan
+
+@pytest.fixture
+def stripe_calls(main4, monkeypatch):
+    calls = []
+
+    def create_payment_intent(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(id="pi_test")
+
+    monkeypatch.setattr(main4.stripe.PaymentIntent, "create", create_payment_intent)
+    return calls
+
+def test_complete_task_charges_the_requester(client, stripe_calls):
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    accept_task(client, "executor", task_id)
+
+    assert client.put(f"/tasks/{task_id}/complete", params={"identity": "executor"}).status_code == 200
+    assert len(stripe_calls) == 1
+    assert stripe_calls[0]["amount"] == 100
+
+def test_status_is_stored_and_filtered_by_name(client, stripe_calls):
+    create_user(client, "requester")
+    executor_id = create_user(client, "executor")
+    open_task_id = create_task(client, "requester", "Open")
+    completed_task_id = create_task(client, "requester", "Completed")
+    canceled_task_id = create_task(client, "requester", "Canceled")
+    for task_id in (completed_task_id, canceled_task_id):
+        assert accept_task(client, "executor", task_id).status_code == 200
+    assert client.put(f"/tasks/{completed_task_id}/complete", params={"identity": "executor"}).status_code == 200
+    assert client.put(f"/tasks/{canceled_task_id}/cancel", params={"identity": "requester"}).status_code == 200
+
+    statuses = {task["id"]: task["status"] for task in list_tasks(client, "executor")}
+    assert statuses == {open_task_id: "unassigned", completed_task_id: "completed", canceled_task_id: "canceled"}
+    for status, task_id in (("unassigned", open_task_id), ("completed", completed_task_id), ("canceled", canceled_task_id)):
+        assert [task["id"] for task in list_tasks(client, "executor", status=status)] == [task_id]
+    assert list_tasks(client, "executor", status="accepted") == []
+    assert len(list_tasks(client, "executor", executed_by_id=executor_id)) == 2
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    async def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?op={operation}"
+
+    async def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[Key])}
+
+def test_image_message_is_uploaded_through_a_presigned_url(client, main4, monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(main4, "s3", s3)
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    accept_task(client, "executor", task_id)
+
+    presign = client.post(f"/tasks/{task_id}/messages/image/presign", params={"identity": "executor"})
+    assert presign.status_code == 200
+    object_name = presign.json()["object_name"]
+    assert object_name.startswith(f"task_{task_id}_message_")
+    assert presign.json()["upload_url"].endswith(f"/{object_name}?op=put_object")
+
+    def record_image():
+        return client.post(f"/tasks/{task_id}/messages/image", params={"identity": "executor"}, json={"object_name": object_name})
+
+    # Nothing has been PUT to the presigned URL yet
+    assert record_image().status_code == 400
+    s3.objects[object_name] = b"jpeg bytes"
+    response = record_image()
+    assert response.status_code == 200
+
+    [message] = client.get(f"/tasks/{task_id}/messages", params={"identity": "requester"}).json()
+    assert message["id"] == response.json()
+    assert message["image_url"].endswith(f"/{object_name}")
+
+def test_image_keys_are_scoped_to_their_task(client, main4, monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(main4, "s3", s3)
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    accept_task(client, "executor", task_id)
+    s3.objects["task_other_message_1.jpg"] = b"jpeg bytes"
+
+    response = client.post(f"/tasks/{task_id}/messages/image", params={"identity": "executor"}, json={"object_name": "task_other_message_1.jpg"})
+    assert response.status_code == 400
+    create_user(client, "stranger")
+    assert client.post(f"/tasks/{task_id}/messages/image/presign", params={"identity": "stranger"}).status_code == 403
+
+def test_current_user_is_cached(client, main4):
+    user_id = create_user(client, "requester")
+    assert list_tasks(client, "requester") == []
+    cached = client.portal.call(main4.redis.get, main4.user_cache_key("requester"))
+    assert json.loads(cached)["id"] == user_id
+
+    async def delete_user():
+        async with main4.AsyncSessionLocal() as db:
+            await db.execute(delete(main4.User).where(main4.User.id == user_id))
+            await db.commit()
+
+    # Served from the cache, so the lookup no longer needs the row
+    client.portal.call(delete_user)
+    assert list_tasks(client, "requester") == []
+
+def test_update_user_drops_the_cached_user(client, main4):
+    user_id = create_user(client, "requester")
+    list_tasks(client, "requester")
+    response = client.put(f"/users/{user_id}", params={"identity": "requester"}, json={"display_name": "Renamed"})
+    assert response.status_code == 200
+    assert client.portal.call(main4.redis.get, main4.user_cache_key("requester")) is None
+
+def test_redis_outage_falls_back_to_the_database(client, redis_server):
+    create_user(client, "requester")
+    task_id = create_task(client, "requester")
+    redis_server.connected = False
+
+    response = client.get(f"/tasks/{task_id}/messages", params={"identity": "requester"})
+    assert response.status_code == 200
+
+def test_task_list_is_cached_until_a_write(client, main4):
+    requester_id = create_user(client, "requester")
+    create_user(client, "viewer")
+    first_task_id = create_task(client, "requester", "First")
+    assert [task["id"] for task in list_tasks(client, "viewer")] == [first_task_id]
+
+    async def insert_task_behind_the_cache():
+        async with main4.AsyncSessionLocal() as db:
+            db.add(main4.Task(description="Hidden", max_price=100, min_price=50, requested_by_id=requester_id))
+            await db.commit()
+
+    # A write that skips invalidate_task_lists is not visible until the version changes
+    client.portal.call(insert_task_behind_the_cache)
+    assert [task["id"] for task in list_tasks(client, "viewer")] == [first_task_id]
+
+    create_task(client, "requester", "Second")
+    assert client.portal.call(main4.redis.get, main4.TASK_LIST_VERSION_KEY) == "2"
+    assert len(list_tasks(client, "viewer")) == 3
+
+def test_stale_task_list_is_served_while_another_caller_rebuilds(client, main4):
+    requester_id = create_user(client, "requester")
+    viewer_id = create_user(client, "viewer")
+    first_task_id = create_task(client, "requester", "First")
+    assert [task["id"] for task in list_tasks(client, "viewer")] == [first_task_id]
+
+    async def invalidate_with_rebuild_in_progress():
+        async with main4.AsyncSessionLocal() as db:
+            db.add(main4.Task(description="Second", max_price=100, min_price=50, requested_by_id=requester_id))
+            await db.commit()
+        await main4.invalidate_task_lists()
+        cache_key, _ = await main4.task_list_cache_keys(main4.TaskQuery(), 0, 100, viewer_id)
+        await main4.redis.set(f"{cache_key}:lock", 1)
+        return cache_key
+
+    cache_key = client.portal.call(invalidate_with_rebuild_in_progress)
+    assert [task["id"] for task in list_tasks(client, "viewer")] == [first_task_id]
+
+    # Once the other caller is done the next request rebuilds from the database
+    client.portal.call(main4.redis.delete, f"{cache_key}:lock")
+    assert len(list_tasks(client, "viewer")) == 2
+
+def test_message_batch_is_inserted_in_order(client):
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    accept_task(client, "executor", task_id)
+
+    texts = ["first", "second", "third"]
+    response = client.post(f"/tasks/{task_id}/messages/batch", params={"identity": "executor"}, json={"items": [{"text": text} for text in texts]})
+    assert response.status_code == 200
+    message_ids = response.json()
+
+    messages = client.get(f"/tasks/{task_id}/messages", params={"identity": "requester"}).json()
+    assert [(message["id"], message["text"]) for message in messages] == list(zip(message_ids, texts))
+
+def test_messages_are_paged_by_id(client):
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    accept_task(client, "executor", task_id)
+    response = client.post(f"/tasks/{task_id}/messages/batch", params={"identity": "executor"}, json={"items": [{"text": str(i)} for i in range(5)]})
+    message_ids = response.json()
+
+    def get_page(**params):
+        return client.get(f"/tasks/{task_id}/messages", params={"identity": "requester", **params})
+
+    first_page = get_page(limit=2).json()
+    assert [message["id"] for message in first_page] == message_ids[:2]
+    second_page = get_page(after_id=first_page[-1]["id"], limit=2).json()
+    assert [message["id"] for message in second_page] == message_ids[2:4]
+    assert get_page(limit=-1).status_code == 422
+    assert get_page(limit=10_000).status_code == 422
+
+def test_due_accepted_tasks_are_canceled(client, main4):
+    create_user(client, "requester")
+    create_user(client, "executor")
+    overdue_task_id = create_task(client, "requester", "Overdue")
+    recent_task_id = create_task(client, "requester", "Recent")
+    for task_id in (overdue_task_id, recent_task_id):
+        accept_task(client, "executor", task_id)
+    deadlines = dict(client.portal.call(lambda: main4.redis.zrange(main4.TASK_EXPIRY_KEY, 0, -1, withscores=True)))
+    assert set(deadlines) == {str(overdue_task_id), str(recent_task_id)}
+
+    # Move one deadline into the past; the other is still a day away
+    client.portal.call(main4.redis.zadd, main4.TASK_EXPIRY_KEY, {overdue_task_id: 0})
+    assert client.portal.call(main4.expire_due_tasks, time.time_ns() // 1_000_000)
+    statuses = {task["id"]: task["status"] for task in list_tasks(client, "executor")}
+    assert statuses == {overdue_task_id: "canceled", recent_task_id: "accepted"}
+    remaining = client.portal.call(lambda: main4.redis.zrange(main4.TASK_EXPIRY_KEY, 0, -1))
+    assert remaining == [str(recent_task_id)]
+
+def test_stripe_key_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv("STRIPE_API_KEY", "sk_test_env")
+    try:
+        assert load_main4().stripe.api_key == "sk_test_env"
+    finally:
+        sys.modules.pop("main4", None)
+
+def test_list_endpoints_do_not_build_orm_instances(client, main4):
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    accept_task(client, "executor", task_id)
+    client.post(f"/tasks/{task_id}/messages/batch", params={"identity": "executor"}, json={"items": [{"text": "hello"}]})
+
+    loaded = []
+    def record_load(target, context):
+        loaded.append(target)
+
+    for model in (main4.Task, main4.Message):
+        event.listen(model, "load", record_load)
+    try:
+        [task] = list_tasks(client, "requester")
+        [message] = client.get(f"/tasks/{task_id}/messages", params={"identity": "requester"}).json()
+    finally:
+        for model in (main4.Task, main4.Message):
+            event.remove(model, "load", record_load)
+
+    assert task["status"] == "accepted"
+    assert message["text"] == "hello"
+    # Only the task row used for the messages authorisation check is loaded as an entity
+    assert [type(instance) for instance in loaded] == [main4.Task]
+
+def test_task_ids_are_hex_ulids(client):
+    create_user(client, "requester")
+    create_user(client, "executor")
+    task_id = create_task(client, "requester")
+    assert len(task_id) == 32 and bytes.fromhex(task_id)
+
+    for bad_id in ("1", task_id[:-2], f" {task_id[1:]}", "z" * 32):
+        assert accept_task(client, "executor", bad_id).status_code == 400
+    assert accept_task(client, "executor", "0" * 32).status_code == 404
+    assert accept_task(client, "executor", task_id.upper()).status_code == 200
+
+def test_accept_that_loses_a_race_is_rejected(client, main4):
+    create_user(client, "requester")
+    winner_id = create_user(client, "winner")
+    create_user(client, "loser")
+    task_id = create_task(client, "requester")
+
+    async def race():
+        async with main4.AsyncSessionLocal() as loser_db, main4.AsyncSessionLocal() as winner_db:
+            # The loser's session already holds the task as unassigned when the winner accepts it
+            loser = await main4.get_current_user("loser", loser_db)
+            stale_task = await loser_db.get(main4.Task, bytes.fromhex(task_id))
+            await loser_db.commit()
+            await main4.accept_task(task_id, await main4.get_current_user("winner", winner_db), winner_db)
+            assert stale_task.status == main4.STATUS_UNASSIGNED
+            with pytest.raises(main4.HTTPException) as excinfo:
+                await main4.accept_task(task_id, loser, loser_db)
+            return excinfo.value.status_code
+
+    assert client.portal.call(race) == 400
+    [task] = list_tasks(client, "requester")
+    assert task["executed_by_id"] == winner_id